@@ -12,8 +12,11 @@
 from __future__ import annotations
 
 import asyncio
+import logging
 import os
 import re
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
 from dotenv import load_dotenv
@@ -69,8 +72,67 @@ SESSION_NAME: str = os.getenv("SESSION_NAME", "user_session")
 
 
 FORWARD_ENABLED: bool = True
-PROCESSED_ALBUM_IDS: set[int] = set()
-PENDING_ALBUMS: dict[int, list] = {}
+
+# Команды управления пересылкой (в личных сообщениях самому себе)
+_STOP_CMDS: frozenset[str] = frozenset({"/stop", "stop", "стоп"})
+_START_CMDS: frozenset[str] = frozenset({"/start", "start", "пуск"})
+# Более длинные сообщения точно не команды (с запасом на пробелы вокруг)
+_CMD_MAX_LEN: int = 16
+
+# Сколько последних альбомов помнить (чтобы память не росла бесконечно)
+MAX_TRACKED_ALBUMS: int = 4096
+# Сколько секунд ждать подпись к альбому, прежде чем забыть о нём
+PENDING_ALBUM_TTL: float = 600.0
+
+PROCESSED_ALBUM_IDS: OrderedDict[int, None] = OrderedDict()
+# grouped_id -> (time.monotonic() на момент получения, медиа альбома)
+PENDING_ALBUMS: OrderedDict[int, tuple[float, list]] = OrderedDict()
+
+
+def _mark_album(gid: int) -> None:
+    """Помечает альбом как отправленный, вытесняя самые старые записи."""
+    PROCESSED_ALBUM_IDS[gid] = None
+    PROCESSED_ALBUM_IDS.move_to_end(gid)
+    if len(PROCESSED_ALBUM_IDS) > MAX_TRACKED_ALBUMS:
+        PROCESSED_ALBUM_IDS.popitem(last=False)
+
+
+def _add_pending_album(gid: int, files: list) -> None:
+    """Откладывает альбом без подписи, вытесняя устаревшие и самые старые записи."""
+    now = time.monotonic()
+    PENDING_ALBUMS[gid] = (now, files)
+    PENDING_ALBUMS.move_to_end(gid)
+
+    # Записи упорядочены по времени добавления, поэтому устаревшие всегда в начале
+    while PENDING_ALBUMS:
+        oldest_ts, _ = next(iter(PENDING_ALBUMS.values()))
+        if now - oldest_ts <= PENDING_ALBUM_TTL:
+            break
+        PENDING_ALBUMS.popitem(last=False)
+
+    if len(PENDING_ALBUMS) > MAX_TRACKED_ALBUMS:
+        PENDING_ALBUMS.popitem(last=False)
+
+
+# Подписи источников для логов: chat_id -> username (или сам chat_id)
+_SRC_LABEL_CACHE: dict[int, str | int] = {}
+
+
+def _src_label(event) -> str | int:
+    """Возвращает username чата-источника (или его chat_id), кэшируя результат."""
+    cid = event.chat_id
+    label = _SRC_LABEL_CACHE.get(cid)
+    if label is None:
+        label = event.chat.username or cid
+        _SRC_LABEL_CACHE[cid] = label
+    return label
+
+# ==========================
+# ЛОГИРОВАНИЕ
+# ==========================
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+log = logging.getLogger("forwarder")
 
 # ==========================
 # ИНИЦИАЛИЗАЦИЯ КЛИЕНТА
@@ -79,6 +141,56 @@ PENDING_ALBUMS: dict[int, list] = {}
 client = TelegramClient(SESSION_NAME, API_ID, API_HASH)
 
 
+# ==========================
+# ОЧЕРЕДЬ ОТПРАВКИ
+# ==========================
+
+# Сколько отправок выполняется параллельно. По умолчанию 1, чтобы посты
+# появлялись в TARGET_CHAT в том же порядке, что и в каналах-источниках.
+SEND_WORKERS: int = int(os.getenv("SEND_WORKERS", "1"))
+
+# Не больше ~30 сообщений в секунду (глобальный лимит Telegram)
+SEND_RATE_PER_SEC: float = 30.0
+
+# Если очередь заполнена, обработчики ждут освобождения места
+_OUT_Q: asyncio.Queue = asyncio.Queue(maxsize=256)
+
+_send_lock = asyncio.Lock()
+_next_send_at: float = 0.0
+
+
+async def _enqueue_send(send, *args, ok_msg: str, err_msg: str, src, **kwargs) -> None:
+    """Ставит отправку в очередь; ok_msg/err_msg пишутся в лог по результату."""
+    await _OUT_Q.put((send, args, kwargs, ok_msg, err_msg, src))
+
+
+async def _throttle() -> None:
+    """Выдерживает интервал между отправками, общий для всех воркеров."""
+    global _next_send_at
+    async with _send_lock:
+        now = asyncio.get_running_loop().time()
+        if _next_send_at > now:
+            await asyncio.sleep(_next_send_at - now)
+            now = _next_send_at
+        _next_send_at = now + 1 / SEND_RATE_PER_SEC
+
+
+async def _send_worker() -> None:
+    while True:
+        send, args, kwargs, ok_msg, err_msg, src = await _OUT_Q.get()
+        try:
+            await _throttle()
+            await send(*args, **kwargs)
+            log.info(ok_msg, src)
+        except RPCError as e:
+            log.error(err_msg, e)
+        except Exception:
+            # Воркер не должен падать, иначе очередь перестанет разбираться
+            log.exception(err_msg, "непредвиденная ошибка")
+        finally:
+            _OUT_Q.task_done()
+
+
 # ==========================
 # ОБРАБОТЧИК НОВЫХ СООБЩЕНИЙ
 # ==========================
@@ -108,32 +220,28 @@ async def forward_handler(event: events.NewMessage.Event) -> None:
     if not FORWARD_ENABLED:
         return
 
-    try:
-        text = msg.message or ""
-
-        # Если есть медиа (фото, видео, документ, голос и т.д.)
-        if msg.media:
-            await client.send_file(
-                TARGET_CHAT,
-                msg.media,
-                caption=text,
-                link_preview=False,
-            )
-        # Если просто текст
-        elif msg.message:
-            await client.send_message(
-                TARGET_CHAT,
-                text,
-                link_preview=False,
-            )
-        # Нечего отправлять
-        else:
-            return
+    text = msg.message or ""
 
-        src = event.chat.username or event.chat_id
-        print(f"Переслано сообщение из {src}")
-    except RPCError as e:
-        print(f"[ERROR] Ошибка при отправке сообщения: {e}")
+    # Если есть медиа (фото, видео, документ, голос и т.д.)
+    if msg.media:
+        send, payload, extra = client.send_file, msg.media, {"caption": text}
+    # Если просто текст
+    elif text:
+        send, payload, extra = client.send_message, text, {}
+    # Нечего отправлять
+    else:
+        return
+
+    await _enqueue_send(
+        send,
+        TARGET_CHAT,
+        payload,
+        link_preview=False,
+        ok_msg="Переслано сообщение из %s",
+        err_msg="Ошибка при отправке сообщения: %s",
+        src=_src_label(event),
+        **extra,
+    )
 
 
 @client.on(events.Album(chats=SOURCE_CHANNELS))
@@ -152,8 +260,9 @@ async def album_handler(event: events.Album.Event) -> None:
             continue
         if m.media:
             files.append(m.media)
-        if not caption and (m.message or ""):
-            caption = m.message
+        text = m.message
+        if not caption and text:
+            caption = text
 
     if not files:
         return
@@ -162,33 +271,34 @@ async def album_handler(event: events.Album.Event) -> None:
 
     # Если альбом без подписи, откладываем его до появления подписи
     if gid is not None and not caption:
-        global PENDING_ALBUMS
-        PENDING_ALBUMS[gid] = files
-        src = event.chat.username or event.chat_id
-        print(f"Получен альбом без описания из {src}, ожидаю подпись")
+        _add_pending_album(gid, files)
+        src = _src_label(event)
+        log.info("Получен альбом без описания из %s, ожидаю подпись", src)
         return
 
     if gid is not None:
-        global PROCESSED_ALBUM_IDS
         if gid in PROCESSED_ALBUM_IDS:
             return
-        PROCESSED_ALBUM_IDS.add(gid)
-
-    try:
-        await client.send_file(
-            TARGET_CHAT,
-            files,
-            caption=caption,
-            link_preview=False,
-        )
-
-        src = event.chat.username or event.chat_id
-        print(f"Переслан альбом из {src}")
-    except RPCError as e:
-        print(f"[ERROR] Ошибка при отправке альбома: {e}")
+        _mark_album(gid)
+
+    await _enqueue_send(
+        client.send_file,
+        TARGET_CHAT,
+        files,
+        caption=caption,
+        link_preview=False,
+        ok_msg="Переслан альбом из %s",
+        err_msg="Ошибка при отправке альбома: %s",
+        src=_src_label(event),
+    )
 
 
-@client.on(events.MessageEdited(chats=SOURCE_CHANNELS))
+@client.on(
+    events.MessageEdited(
+        chats=SOURCE_CHANNELS,
+        func=lambda e: getattr(e.message, "grouped_id", None) in PENDING_ALBUMS,
+    )
+)
 async def album_caption_edited_handler(event: events.MessageEdited.Event) -> None:
     if not FORWARD_ENABLED:
         return
@@ -198,55 +308,47 @@ async def album_caption_edited_handler(event: events.MessageEdited.Event) -> Non
     if getattr(msg, "action", None):
         return
 
-    gid = getattr(msg, "grouped_id", None)
-    if gid is None:
-        return
+    gid = msg.grouped_id
 
-    if not msg.message:
+    caption = msg.message
+    if not caption:
         return
 
-    global PENDING_ALBUMS, PROCESSED_ALBUM_IDS
-
-    files = PENDING_ALBUMS.pop(gid, None)
+    entry = PENDING_ALBUMS.pop(gid, None)
+    files = entry[1] if entry else None
     if not files:
         return
 
     if gid in PROCESSED_ALBUM_IDS:
         return
 
-    PROCESSED_ALBUM_IDS.add(gid)
-
-    caption = msg.message or ""
-
-    try:
-        await client.send_file(
-            TARGET_CHAT,
-            files,
-            caption=caption,
-            link_preview=False,
-        )
-
-        src = event.chat.username or event.chat_id
-        print(f"Переслан альбом (по появлению подписи) из {src}")
-    except RPCError as e:
-        print(f"[ERROR] Ошибка при отправке альбома (edit): {e}")
+    _mark_album(gid)
+
+    await _enqueue_send(
+        client.send_file,
+        TARGET_CHAT,
+        files,
+        caption=caption,
+        link_preview=False,
+        ok_msg="Переслан альбом (по появлению подписи) из %s",
+        err_msg="Ошибка при отправке альбома (edit): %s",
+        src=_src_label(event),
+    )
 
 
-@client.on(events.NewMessage)
+@client.on(events.NewMessage(outgoing=True, func=lambda e: e.is_private))
 async def control_handler(event: events.NewMessage.Event) -> None:
     msg = event.message
 
-    if not event.is_private:
+    raw = msg.message
+    if not raw or len(raw) > _CMD_MAX_LEN:
         return
 
-    if not getattr(msg, "out", False):
-        return
-
-    text = (msg.message or "").strip().lower()
+    text = raw.strip().lower()
 
     global FORWARD_ENABLED
 
-    if text in {"/stop", "stop", "стоп"}:
+    if text in _STOP_CMDS:
         if not FORWARD_ENABLED:
             return
         FORWARD_ENABLED = False
@@ -254,7 +356,7 @@ async def control_handler(event: events.NewMessage.Event) -> None:
             await event.reply("Forwarding stopped.")
         except RPCError:
             pass
-    elif text in {"/start", "start", "пуск"}:
+    elif text in _START_CMDS:
         if FORWARD_ENABLED:
             return
         FORWARD_ENABLED = True
@@ -269,12 +371,15 @@ async def control_handler(event: events.NewMessage.Event) -> None:
 # ==========================
 
 def main() -> None:
-    print("=== Telegram userbot forwarder (systemd) ===")
-    print("Клиент запущен. Ожидаю новые сообщения:")
+    log.info("=== Telegram userbot forwarder (systemd) ===")
+    log.info("Клиент запущен. Ожидаю новые сообщения:")
 
     for ch in SOURCE_CHANNELS:
-        print(f" - {ch}")
-    print(f"Целевой чат: {TARGET_CHAT}")
+        log.info(" - %s", ch)
+    log.info("Целевой чат: %s", TARGET_CHAT)
+
+    for _ in range(SEND_WORKERS):
+        client.loop.create_task(_send_worker())
 
     client.run_until_disconnected()
 